@@ -32,8 +32,8 @@ Copyright: All rights reserved (c) Yehonatan Simian 2024
 
 from typing import Tuple, List, Literal
 from enum import Enum
-from abc import ABC
-import random
+import os
+import re
 import socket
 import string
 import struct
@@ -54,57 +54,66 @@ class Status(Enum):
     ERROR_NO_CLIENT = 1002
     ERROR_GENERAL = 1003
 
+# wire formats
+
+_REQUEST_HEADER = struct.Struct('<I B B')
+_REQUEST_HEADER_WITH_NAME_LEN = struct.Struct('<I B B H')
+_RESPONSE_HEADER = struct.Struct('<B H')
+_NAME_LEN = struct.Struct('<H')
+_PAYLOAD_SIZE = struct.Struct('<I')
+
 # validations
+
+_UINT_RANGES = {
+    "uint8_t": (0, 0xFF),
+    "uint16_t": (0, 0xFFFF),
+    "uint32_t": (0, 0xFFFFFFFF),
+    "uint64_t": (0, 0xFFFFFFFFFFFFFFFF)
+}
     
 def validate_range(var_name: str, number: int, uint_type: Literal["uint8_t", "uint16_t", "uint32_t", "uint64_t"]) -> None:
-    ranges = {
-        "uint8_t": (0, 0xFF),
-        "uint16_t": (0, 0xFFFF),
-        "uint32_t": (0, 0xFFFFFFFF),
-        "uint64_t": (0, 0xFFFFFFFFFFFFFFFF)
-    }
-
-    min_val, max_val = ranges[uint_type]
+    min_val, max_val = _UINT_RANGES[uint_type]
     if not (min_val <= number <= max_val):
         raise ValueError(f"{var_name} {number} is out of range for {uint_type}.")
 
 def validate_op(op: Op) -> None:
-    if op not in Op:
-        raise ValueError(f"Invalid op: {op.value}")
-    
-def validate_status(status: Status) -> None:
-    if status not in Status:
-        raise ValueError(f"Invalid status: {status}")
+    if not isinstance(op, Op):
+        raise ValueError(f"Invalid op: {op}")
+
+_STATUS_BY_CODE = {status.value: status for status in Status}
+
+def parse_status(code: int) -> Status:
+    status = _STATUS_BY_CODE.get(code)
+    if status is None:
+        raise ValueError(f"Invalid status: {code}")
+    return status
 
 # common classes
     
-class Filename:
-    def __init__(self, filename: str):
-        validate_range("name_len", len(filename), "uint16_t")
-        self.validate_filename(filename)
-        self.name_len = len(filename)
-        self.filename = filename
+_VALID_FILENAME_CHARS_DELETION = str.maketrans('', '', "-_.() %s%s" % (string.ascii_letters, string.digits))
+_DIRECTORY_TRAVERSAL = re.compile(r'\.\.|[/\\]')
 
-    @staticmethod
-    def validate_filename(filename: str) -> None:
-        # Check for directory traversal characters
-        if ".." in filename or "/" in filename or "\\" in filename:
-            raise ValueError("Invalid characters in filename")
+def validate_filename(filename: str) -> str:
+    validate_range("name_len", len(filename), "uint16_t")
+
+    # Check for directory traversal characters
+    if _DIRECTORY_TRAVERSAL.search(filename):
+        raise ValueError("Invalid characters in filename")
 
-        # Check for invalid characters
-        valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
-        if any(char not in valid_chars for char in filename):
-            raise ValueError("Invalid characters in filename")
+    # Check for invalid characters (anything left after deleting the valid ones)
+    if filename.translate(_VALID_FILENAME_CHARS_DELETION):
+        raise ValueError("Invalid characters in filename")
+    return filename
 
 class Payload:
-    def __init__(self, size: int, payload: bytes):
+    def __init__(self, size: int, payload: bytearray):
         validate_range("payload.size", size, "uint32_t")
         self.size = size
         self.payload = payload
 
 # requests
 
-class _RequestBase(ABC):
+class _RequestBase:
     def __init__(self, user_id: int, version: int, op: Op):
         validate_range("user_id", user_id, "uint32_t")
         validate_range("version", version, "uint8_t")
@@ -115,29 +124,24 @@ class _RequestBase(ABC):
         self.op = op.value
 
     def pack(self) -> bytes:
-        return struct.pack(
-            f'<I B B',
-            self.user_id,
-            self.version,
-            self.op
-        )
+        return _REQUEST_HEADER.pack(self.user_id, self.version, self.op)
+
+    def send(self, sock: socket.socket) -> None:
+        sock.sendall(self.pack())
 
 Request = _RequestBase
 
 class _RequestWithFileName(_RequestBase):
     def __init__(self, user_id: int, version: int, op: Op, filename: str):
         super().__init__(user_id, version, op)
-        self.filename = Filename(filename)
+        self.filename = validate_filename(filename)
+        self.filename_bytes = filename.encode('ascii') # validated to be ascii only
     
     def pack(self) -> bytes:
-        return struct.pack(
-            f'<I B B H {self.filename.name_len}s',
-            self.user_id,
-            self.version,
-            self.op,
-            self.filename.name_len,
-            self.filename.filename.encode('utf-8')
-        )
+        return b''.join((
+            _REQUEST_HEADER_WITH_NAME_LEN.pack(self.user_id, self.version, self.op, len(self.filename_bytes)),
+            self.filename_bytes
+        ))
 
 class RequestList(_RequestBase):
     def __init__(self, user_id: int, version: int):
@@ -152,26 +156,27 @@ class RequestDelete(_RequestWithFileName):
         super().__init__(user_id, version, Op.DELETE, filename)
 
 class RequestSave(_RequestWithFileName):
-    def __init__(self, user_id: int, version: int, filename: str, file_content: bytes):
+    def __init__(self, user_id: int, version: int, filename: str, source_path: str):
         super().__init__(user_id, version, Op.SAVE, filename)
-        self.payload = Payload(len(file_content), file_content)
+        # the content is streamed from disk on send, only its size is kept in memory
+        self.payload_size = os.path.getsize(source_path)
+        validate_range("payload.size", self.payload_size, "uint32_t")
+        self.source_path = source_path
 
     def pack(self) -> bytes:
-        filename_bytes = self.filename.filename.encode('utf-8')
-        return struct.pack(
-            f'<I B B H {len(filename_bytes)}s I {len(self.payload.payload)}s',
-            self.user_id,
-            self.version,
-            self.op,
-            len(filename_bytes),
-            filename_bytes,
-            len(self.payload.payload),
-            self.payload.payload
-        )
+        # everything but the content, which send streams straight from the file
+        return b''.join((super().pack(), _PAYLOAD_SIZE.pack(self.payload_size)))
+
+    def send(self, sock: socket.socket) -> None:
+        sock.sendall(self.pack())
+        with open(self.source_path, "rb") as f:
+            sent = sock.sendfile(f, 0, self.payload_size)
+        if sent != self.payload_size:
+            raise ValueError(f"{self.source_path} changed while sending.")
 
 # responses
     
-class _ResponseBase(ABC):
+class _ResponseBase:
     def __init__(self, version: int, status: Status):
         self.version = version
         self.status = status
@@ -190,23 +195,23 @@ class ResponseErrorNoClient(_ResponseBase):
         super().__init__(version, Status.ERROR_NO_CLIENT)
 
 class _ResponseWithFileName(_ResponseBase):
-    def __init__(self, version: int, status: Status, filename: Filename):
+    def __init__(self, version: int, status: Status, filename: str):
         super().__init__(version, status)
         self.filename = filename
     
     def __str__(self) -> str:
-        return super().__str__() + f"\nName length: {self.filename.name_len}\nFilename: {self.filename.filename}"
+        return super().__str__() + f"\nName length: {len(self.filename)}\nFilename: {self.filename}"
 
 class ResponseSuccessSave(_ResponseWithFileName):
-    def __init__(self, version: int, filename: Filename):
+    def __init__(self, version: int, filename: str):
         super().__init__(version, Status.SUCCESS_SAVE, filename)
 
 class ResponseErrorNoFile(_ResponseWithFileName):
-    def __init__(self, version: int, filename: Filename):
+    def __init__(self, version: int, filename: str):
         super().__init__(version, Status.ERROR_NO_FILE, filename)
 
 class _ResponseWithFileNameAndPayload(_ResponseWithFileName):
-    def __init__(self, version: int, status: Status, filename: Filename, payload: Payload):
+    def __init__(self, version: int, status: Status, filename: str, payload: Payload):
         super().__init__(version, status, filename)
         self.payload = payload
     
@@ -214,16 +219,30 @@ class _ResponseWithFileNameAndPayload(_ResponseWithFileName):
         return super().__str__() + f"\nPayload size: {self.payload.size}"
 
 class ResponseSuccessRestore(_ResponseWithFileNameAndPayload):
-    def __init__(self, version: int, filename: Filename, payload: Payload):
+    def __init__(self, version: int, filename: str, payload: Payload):
         super().__init__(version, Status.SUCCESS_RESTORE, filename, payload)
 
 class ResponseSuccessList(_ResponseWithFileNameAndPayload):
-    def __init__(self, version: int, filename: Filename, payload: Payload):
+    def __init__(self, version: int, filename: str, payload: Payload):
         super().__init__(version, Status.SUCCESS_LIST, filename, payload)
 
     def __str__(self) -> str:
         return super().__str__() + f"\nFiles list:\n{self.payload.payload.decode('utf-8')}"
-    
+
+# response classes by status, grouped by the fields they carry
+
+_RESPONSES_WITHOUT_FILENAME = {
+    Status.ERROR_GENERAL: ResponseErrorGeneral,
+    Status.ERROR_NO_CLIENT: ResponseErrorNoClient
+}
+_RESPONSES_WITH_FILENAME = {
+    Status.SUCCESS_SAVE: ResponseSuccessSave,
+    Status.ERROR_NO_FILE: ResponseErrorNoFile
+}
+_RESPONSES_WITH_PAYLOAD = {
+    Status.SUCCESS_RESTORE: ResponseSuccessRestore,
+    Status.SUCCESS_LIST: ResponseSuccessList
+}
 
 class FileHandler:
     SERVER_INFO_FILE = "server.info"
@@ -260,7 +279,7 @@ class FileHandler:
     def read_backup_info(self) -> List[str]:
         try:
             with open(self.backup_info_file, 'r') as file:
-                filenames = [line.strip() for line in file]
+                filenames = list(map(str.strip, file.read().splitlines()))
         except FileNotFoundError:
             raise Exception(f"{self.backup_info_file} file not found.")
         except Exception as e:
@@ -271,16 +290,25 @@ class FileHandler:
 
 class UniqueIDGenerator:
     def __init__(self):
-        self.generated_ids = set()
+        self._next = 0
+        # an odd multiplier makes the mapping a permutation of the 32-bit ids
+        self._multiplier = int.from_bytes(os.urandom(4), 'little') | 1
+        self._mask = int.from_bytes(os.urandom(4), 'little')
+
+    @staticmethod
+    def generate_id() -> int:
+        # a single id needs no bookkeeping, just 4 uniform bytes
+        return int.from_bytes(os.urandom(4), 'little')
 
     def generate_unique_id(self) -> int:
-        while True:
-            unique_id = random.randint(0, 0xFFFFFFFF)
-            if unique_id not in self.generated_ids:
-                self.generated_ids.add(unique_id)
-                return unique_id
+        # unique by construction for 2^32 calls, no retries and no stored ids
+        unique_id = ((self._next * self._multiplier) & 0xFFFFFFFF) ^ self._mask
+        self._next = (self._next + 1) & 0xFFFFFFFF
+        return unique_id
 
 class Client:
+    SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+
     def __init__(self, ip_address: str, port: int):
         self.ip_address = ip_address
         self.port = port
@@ -288,85 +316,72 @@ class Client:
     def send_request(self, request: Request) -> Response:
         # send request
         my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        # set before connecting, so the window scale is negotiated accordingly
+        my_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.SOCKET_BUFFER_SIZE)
+        my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SOCKET_BUFFER_SIZE)
         my_socket.connect((self.ip_address, self.port))
-        my_socket.send(request.pack())
+        request.send(my_socket)
 
         # receive response
-        data = b""
-        while True:
-            part = my_socket.recv(1024)
-            if not part:
-                break 
-            data += part
-        response = self.unpack_response(data)
+        response = self.receive_response(my_socket)
 
         # bye
         self.handle_response(response)
         my_socket.close()
         return response
 
-    def handle_response(self, response: Response) -> None:
-        print(response, '\n')
-
-    def unpack_response(self, data: bytes) -> Response:
-        if len(data) < 3:
-            raise Exception(f"Response too short; got {len(data)} bytes but expected at least 3")
-        
-        # Unpack the version and status
-        version, status = struct.unpack('<B H', data[:3])
-        status = Status(status)
+    @staticmethod
+    def receive_exactly(sock: socket.socket, size: int) -> bytearray:
+        # allocated once at its final size and filled in place
+        data = bytearray(size)
+        view = memoryview(data)
+        while view:
+            received = sock.recv_into(view, 0, socket.MSG_WAITALL)
+            if not received:
+                raise Exception(f"Response too short; got {size - len(view)} bytes but expected {size}")
+            view = view[received:]
+        return data
+
+    def receive_response(self, sock: socket.socket) -> Response:
+        # read exactly the bytes the response declares, segment by segment, parsing as we go
+        version, status = _RESPONSE_HEADER.unpack(self.receive_exactly(sock, _RESPONSE_HEADER.size))
+        status = parse_status(status)
         validate_range("version", version, "uint8_t")
-        validate_status(status)
 
-        if status == Status.ERROR_GENERAL:
-            return ResponseErrorGeneral(version)
-        elif status == Status.ERROR_NO_CLIENT:
-            return ResponseErrorNoClient(version)
-        
-        if len(data) < 5:
-            raise Exception(f"Response too short; got {len(data)} bytes but expected at least 5")
-        
-        # Unpack the name_len and filename
-        name_len = struct.unpack('<H', data[3:5])[0]
-        filename_start = 5
-        filename_end = filename_start + name_len
-        filename = data[filename_start:filename_end].decode('ascii')
-        if len(filename) != name_len:
-            raise ValueError(f"filename length ({len(filename)}) does not match name_len ({name_len}).")
-        filename_obj = Filename(filename)
-
-        if status == Status.SUCCESS_SAVE:
-            return ResponseSuccessSave(version, filename_obj)
-        elif status == Status.ERROR_NO_FILE:
-            return ResponseErrorNoFile(version, filename_obj)
-        
-        if len(data) < filename_end + 4:
-            raise Exception(f"Response too short; got {len(data)} bytes but expected at least {filename_end + 4}")
-
-        # Unpack the payload
-        payload_size = struct.unpack('<I', data[filename_end:filename_end+4])[0]
-        payload_start = filename_end + 4
-        payload_end = payload_start + payload_size
-        payload = data[payload_start:payload_end]
-        if len(payload) != payload_size:
-            raise ValueError(f"payload size ({len(payload)}) does not match payload_size ({payload_size}).")
-        payload_obj = Payload(payload_size, payload)
-
-        if status == Status.SUCCESS_RESTORE:
-            return ResponseSuccessRestore(version, filename_obj, payload_obj)
-        elif status == Status.SUCCESS_LIST:
-            return ResponseSuccessList(version, filename_obj, payload_obj)
-        
+        response_class = _RESPONSES_WITHOUT_FILENAME.get(status)
+        if response_class is not None:
+            return response_class(version)
+
+        (name_len,) = _NAME_LEN.unpack(self.receive_exactly(sock, _NAME_LEN.size))
+        response_class = _RESPONSES_WITH_FILENAME.get(status)
+        if response_class is not None:
+            filename = self.receive_exactly(sock, name_len).decode('ascii')
+            return response_class(version, filename)
+
+        # the payload size directly follows the filename, fetch both at once
+        data = self.receive_exactly(sock, name_len + _PAYLOAD_SIZE.size)
+        filename = data[:name_len].decode('ascii')
+        (payload_size,) = _PAYLOAD_SIZE.unpack_from(data, name_len)
+
+        # the payload gets its own buffer, handed to Payload without another copy
+        payload = Payload(payload_size, self.receive_exactly(sock, payload_size))
+
+        response_class = _RESPONSES_WITH_PAYLOAD.get(status)
+        if response_class is not None:
+            return response_class(version, filename, payload)
+
         raise Exception(f"Invalid status: {status}")
 
+    def handle_response(self, response: Response) -> None:
+        print(response, '\n')
+
 class RequestGenerator:
     def __init__(self, user_id):
         self.user_id = user_id
 
     def generate_save_request(self, filename: str) -> Request:
-        with open(filename, "rb") as f:
-            content = f.read()
-        return RequestSave(self.user_id, VERSION, filename, content)
+        return RequestSave(self.user_id, VERSION, filename, filename)
 
     def generate_restore_request(self, filename: str) -> Request:
         return RequestRestore(self.user_id, VERSION, filename)
@@ -378,8 +393,7 @@ class RequestGenerator:
         return RequestList(self.user_id, VERSION)
 
 def main():
-    uniqueIDGenerator = UniqueIDGenerator() 
-    unique_id = uniqueIDGenerator.generate_unique_id() # step 1
+    unique_id = UniqueIDGenerator.generate_id() # step 1
 
     reader = FileHandler()
     ip_address, port = reader.read_server_info() # step 2
@@ -36,18 +36,20 @@ The server can respond with the following statuses:
 Copyright: All rights reserved (c) Yehonatan Simian 2024
 """
 
-from typing import Literal
 from enum import Enum
+import contextlib
+import functools
+import hashlib
 import selectors
 import sqlite3
 import socket
 import struct
 import base64
 import time
+import zlib
 import os
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import AES, PKCS1_OAEP
-from Crypto.Hash import SHA256
 
 VERSION = 3
 DEFAULT_PORT = 1256
@@ -56,292 +58,56 @@ PORT_FILE = "port.info"
 
 # CRC-32 implementation
 
+FILE_CHUNK_SIZE = 1 << 16
 
-crctab = [
-    0x00000000,
-    0x04C11DB7,
-    0x09823B6E,
-    0x0D4326D9,
-    0x130476DC,
-    0x17C56B6B,
-    0x1A864DB2,
-    0x1E475005,
-    0x2608EDB8,
-    0x22C9F00F,
-    0x2F8AD6D6,
-    0x2B4BCB61,
-    0x350C9B64,
-    0x31CD86D3,
-    0x3C8EA00A,
-    0x384FBDBD,
-    0x4C11DB70,
-    0x48D0C6C7,
-    0x4593E01E,
-    0x4152FDA9,
-    0x5F15ADAC,
-    0x5BD4B01B,
-    0x569796C2,
-    0x52568B75,
-    0x6A1936C8,
-    0x6ED82B7F,
-    0x639B0DA6,
-    0x675A1011,
-    0x791D4014,
-    0x7DDC5DA3,
-    0x709F7B7A,
-    0x745E66CD,
-    0x9823B6E0,
-    0x9CE2AB57,
-    0x91A18D8E,
-    0x95609039,
-    0x8B27C03C,
-    0x8FE6DD8B,
-    0x82A5FB52,
-    0x8664E6E5,
-    0xBE2B5B58,
-    0xBAEA46EF,
-    0xB7A96036,
-    0xB3687D81,
-    0xAD2F2D84,
-    0xA9EE3033,
-    0xA4AD16EA,
-    0xA06C0B5D,
-    0xD4326D90,
-    0xD0F37027,
-    0xDDB056FE,
-    0xD9714B49,
-    0xC7361B4C,
-    0xC3F706FB,
-    0xCEB42022,
-    0xCA753D95,
-    0xF23A8028,
-    0xF6FB9D9F,
-    0xFBB8BB46,
-    0xFF79A6F1,
-    0xE13EF6F4,
-    0xE5FFEB43,
-    0xE8BCCD9A,
-    0xEC7DD02D,
-    0x34867077,
-    0x30476DC0,
-    0x3D044B19,
-    0x39C556AE,
-    0x278206AB,
-    0x23431B1C,
-    0x2E003DC5,
-    0x2AC12072,
-    0x128E9DCF,
-    0x164F8078,
-    0x1B0CA6A1,
-    0x1FCDBB16,
-    0x018AEB13,
-    0x054BF6A4,
-    0x0808D07D,
-    0x0CC9CDCA,
-    0x7897AB07,
-    0x7C56B6B0,
-    0x71159069,
-    0x75D48DDE,
-    0x6B93DDDB,
-    0x6F52C06C,
-    0x6211E6B5,
-    0x66D0FB02,
-    0x5E9F46BF,
-    0x5A5E5B08,
-    0x571D7DD1,
-    0x53DC6066,
-    0x4D9B3063,
-    0x495A2DD4,
-    0x44190B0D,
-    0x40D816BA,
-    0xACA5C697,
-    0xA864DB20,
-    0xA527FDF9,
-    0xA1E6E04E,
-    0xBFA1B04B,
-    0xBB60ADFC,
-    0xB6238B25,
-    0xB2E29692,
-    0x8AAD2B2F,
-    0x8E6C3698,
-    0x832F1041,
-    0x87EE0DF6,
-    0x99A95DF3,
-    0x9D684044,
-    0x902B669D,
-    0x94EA7B2A,
-    0xE0B41DE7,
-    0xE4750050,
-    0xE9362689,
-    0xEDF73B3E,
-    0xF3B06B3B,
-    0xF771768C,
-    0xFA325055,
-    0xFEF34DE2,
-    0xC6BCF05F,
-    0xC27DEDE8,
-    0xCF3ECB31,
-    0xCBFFD686,
-    0xD5B88683,
-    0xD1799B34,
-    0xDC3ABDED,
-    0xD8FBA05A,
-    0x690CE0EE,
-    0x6DCDFD59,
-    0x608EDB80,
-    0x644FC637,
-    0x7A089632,
-    0x7EC98B85,
-    0x738AAD5C,
-    0x774BB0EB,
-    0x4F040D56,
-    0x4BC510E1,
-    0x46863638,
-    0x42472B8F,
-    0x5C007B8A,
-    0x58C1663D,
-    0x558240E4,
-    0x51435D53,
-    0x251D3B9E,
-    0x21DC2629,
-    0x2C9F00F0,
-    0x285E1D47,
-    0x36194D42,
-    0x32D850F5,
-    0x3F9B762C,
-    0x3B5A6B9B,
-    0x0315D626,
-    0x07D4CB91,
-    0x0A97ED48,
-    0x0E56F0FF,
-    0x1011A0FA,
-    0x14D0BD4D,
-    0x19939B94,
-    0x1D528623,
-    0xF12F560E,
-    0xF5EE4BB9,
-    0xF8AD6D60,
-    0xFC6C70D7,
-    0xE22B20D2,
-    0xE6EA3D65,
-    0xEBA91BBC,
-    0xEF68060B,
-    0xD727BBB6,
-    0xD3E6A601,
-    0xDEA580D8,
-    0xDA649D6F,
-    0xC423CD6A,
-    0xC0E2D0DD,
-    0xCDA1F604,
-    0xC960EBB3,
-    0xBD3E8D7E,
-    0xB9FF90C9,
-    0xB4BCB610,
-    0xB07DABA7,
-    0xAE3AFBA2,
-    0xAAFBE615,
-    0xA7B8C0CC,
-    0xA379DD7B,
-    0x9B3660C6,
-    0x9FF77D71,
-    0x92B45BA8,
-    0x9675461F,
-    0x8832161A,
-    0x8CF30BAD,
-    0x81B02D74,
-    0x857130C3,
-    0x5D8A9099,
-    0x594B8D2E,
-    0x5408ABF7,
-    0x50C9B640,
-    0x4E8EE645,
-    0x4A4FFBF2,
-    0x470CDD2B,
-    0x43CDC09C,
-    0x7B827D21,
-    0x7F436096,
-    0x7200464F,
-    0x76C15BF8,
-    0x68860BFD,
-    0x6C47164A,
-    0x61043093,
-    0x65C52D24,
-    0x119B4BE9,
-    0x155A565E,
-    0x18197087,
-    0x1CD86D30,
-    0x029F3D35,
-    0x065E2082,
-    0x0B1D065B,
-    0x0FDC1BEC,
-    0x3793A651,
-    0x3352BBE6,
-    0x3E119D3F,
-    0x3AD08088,
-    0x2497D08D,
-    0x2056CD3A,
-    0x2D15EBE3,
-    0x29D4F654,
-    0xC5A92679,
-    0xC1683BCE,
-    0xCC2B1D17,
-    0xC8EA00A0,
-    0xD6AD50A5,
-    0xD26C4D12,
-    0xDF2F6BCB,
-    0xDBEE767C,
-    0xE3A1CBC1,
-    0xE760D676,
-    0xEA23F0AF,
-    0xEEE2ED18,
-    0xF0A5BD1D,
-    0xF464A0AA,
-    0xF9278673,
-    0xFDE69BC4,
-    0x89B8FD09,
-    0x8D79E0BE,
-    0x803AC667,
-    0x84FBDBD0,
-    0x9ABC8BD5,
-    0x9E7D9662,
-    0x933EB0BB,
-    0x97FFAD0C,
-    0xAFB010B1,
-    0xAB710D06,
-    0xA6322BDF,
-    0xA2F33668,
-    0xBCB4666D,
-    0xB8757BDA,
-    0xB5365D03,
-    0xB1F740B4,
-]
-
-
-def unsigned(n):
-    """Return the unsigned value of n."""
-    return n & 0xFFFFFFFF
+# This is the POSIX cksum algorithm: CRC-32 with the non-reflected polynomial
+# 0x04C11DB7 over the data followed by its length, complemented. zlib implements
+# the same polynomial reflected, so mirroring the bits of every input byte and of
+# the result lets zlib do the work in C instead of a Python loop per byte.
+
+_REVERSED_BITS = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+
+def _reverse_bits32(n):
+    """Return n with the order of its 32 bits reversed."""
+    return int(f"{n:032b}"[::-1], 2)
+
+
+class Checksum:
+    """An incremental memcrc, for data that arrives in chunks."""
+
+    def __init__(self):
+        # zlib's crc32 complements its input and output, 0xFFFFFFFF is a zero register
+        self.state = 0xFFFFFFFF
+        self.length = 0
+
+    def update(self, b) -> None:
+        """Feed the bytes in b into the checksum."""
+        self.state = zlib.crc32(b.translate(_REVERSED_BITS), self.state)
+        self.length += len(b)
+
+    def digest(self) -> int:
+        """Return the CRC-32 of all the bytes fed so far."""
+        n = self.length
+        length = n.to_bytes((n.bit_length() + 7) // 8, "little")
+        return _reverse_bits32(zlib.crc32(length.translate(_REVERSED_BITS), self.state))
 
 
 def memcrc(b):
     """Compute the CRC-32 of the bytes in b, starting with an initial crc of 0."""
-    n = len(b)
-    c = s = 0
-    for ch in b:
-        tabidx = (s >> 24) ^ ch
-        s = unsigned((s << 8)) ^ crctab[tabidx]
-
-    while n:
-        c = n & 0o377
-        n = n >> 8
-        s = unsigned(s << 8) ^ crctab[(s >> 24) ^ c]
-    return unsigned(~s)
+    checksum = Checksum()
+    checksum.update(b)
+    return checksum.digest()
 
 
 def calculate_crc(fname):
     """Calculate the CRC of a file."""
     try:
-        buffer = open(fname, "rb").read()
-        return f"{memcrc(buffer)}\t{len(buffer)}\t{fname}"
+        checksum = Checksum()
+        with open(fname, "rb") as f:
+            while chunk := f.read(FILE_CHUNK_SIZE):
+                checksum.update(chunk)
+        return f"{checksum.digest()}\t{checksum.length}\t{fname}"
     except IOError:
         print("Unable to open input file", fname)
         exit(-1)
@@ -358,10 +124,11 @@ AES_KEY_SIZE = 16
 ENCRYPTED_AES_KEY_SIZE = 128
 MAX_USER_NAME_LEN = 255
 MAX_FILE_NAME_LEN = 255
+# the client encrypts with a zero IV, bytes are immutable so one instance is shared
+ZERO_IV = bytes(AES_KEY_SIZE)
+EMPTY_CLIENT_ID = bytes(CLIENT_ID_LEN)
 
 REQUEST_MIN_LEN = 23
-MAX_FILE_CONTENT_LENGTH = 0xFFFFFFFF
-MAX_REQUEST_LENGTH = REQUEST_MIN_LEN + MAX_FILE_NAME_LEN + 4 + MAX_FILE_CONTENT_LENGTH
 
 
 class RequestCode(Enum):
@@ -389,22 +156,16 @@ class ResponseCode(Enum):
     GENERAL_ERROR = 1607
 
 
-def validate_range(
-    var_name: str,
-    number: int,
-    uint_type: Literal["uint8_t", "uint16_t", "uint32_t", "uint64_t"],
-) -> None:
-    """Validate that a number is within the range of a given unsigned integer type."""
-    ranges = {
-        "uint8_t": (0, 0xFF),
-        "uint16_t": (0, 0xFFFF),
-        "uint32_t": (0, 0xFFFFFFFF),
-        "uint64_t": (0, 0xFFFFFFFFFFFFFFFF),
-    }
+def validate_uint8(var_name: str, number: int) -> None:
+    """Validate that a number is within the range of uint8_t."""
+    if not 0 <= number <= 0xFF:
+        raise ValueError(f"{var_name} {number} is out of range for uint8_t.")
+
 
-    min_val, max_val = ranges[uint_type]
-    if not min_val <= number <= max_val:
-        raise ValueError(f"{var_name} {number} is out of range for {uint_type}.")
+def validate_uint32(var_name: str, number: int) -> None:
+    """Validate that a number is within the range of uint32_t."""
+    if not 0 <= number <= 0xFFFFFFFF:
+        raise ValueError(f"{var_name} {number} is out of range for uint32_t.")
 
 
 def validate_request_code(code: RequestCode) -> None:
@@ -419,30 +180,53 @@ def validate_response_code(code: ResponseCode) -> None:
         raise ValueError(f"Invalid response code: {code.value}")
 
 
+REQUEST_HEADER = struct.Struct(f"<{CLIENT_ID_LEN}sBHI")
+
+
 class Request:
     """A class to represent a request from the client to the server"""
 
+    # one is built per request, skip the per-instance __dict__
+    __slots__ = ("client_id", "version", "code", "payload_size", "payload")
+
     def __init__(self, buffer: bytes):
         if len(buffer) < REQUEST_MIN_LEN:
             raise ValueError(
                 f"Invalid request length {len(buffer)} < {REQUEST_MIN_LEN}"
             )
-        self.client_id = buffer[:CLIENT_ID_LEN]
-        buffer = buffer[CLIENT_ID_LEN:]
-        header_remaining_len = 7
-        self.version, self.code, self.payload_size = struct.unpack(
-            "<BHI", buffer[:header_remaining_len]
+        self.client_id, self.version, self.code, self.payload_size = (
+            REQUEST_HEADER.unpack_from(buffer)
         )
         self.code = RequestCode(self.code)
         validate_request_code(self.code)
-        validate_range("payload_size", self.payload_size, "uint32_t")
-        validate_range("version", self.version, "uint8_t")
-        buffer = buffer[header_remaining_len:]
-        if len(buffer) != self.payload_size:
+        validate_uint32("payload_size", self.payload_size)
+        validate_uint8("version", self.version)
+        # a view, so the (possibly huge) payload is never copied
+        payload = memoryview(buffer)[REQUEST_HEADER.size :]
+        if len(payload) != self.payload_size:
             raise ValueError(
-                f"Invalid payload length {len(buffer)} != {self.payload_size}"
+                f"Invalid payload length {len(payload)} != {self.payload_size}"
             )
-        self.payload = buffer
+        self.payload = payload
+
+    @classmethod
+    def from_parts(cls, client_id, version, code, payload_size, payload):
+        """Build a request from a header that was already unpacked and checked."""
+        request = cls.__new__(cls)
+        request.client_id = client_id
+        request.version = version
+        request.code = RequestCode(code)
+        request.payload_size = payload_size
+        request.payload = payload
+        return request
+
+
+RESPONSE_HEADER = struct.Struct("<BHI")
+
+
+def pack_response_header(code: ResponseCode, payload_size: int) -> bytes:
+    """Pack a response header of the current version."""
+    return RESPONSE_HEADER.pack(VERSION, code.value, payload_size)
 
 
 class Response:
@@ -454,16 +238,18 @@ class Response:
         self.payload_size = payload_size
 
         validate_response_code(self.code)
-        validate_range("payload_size", self.payload_size, "uint32_t")
+        validate_uint32("payload_size", self.payload_size)
 
     def pack(self) -> bytes:
         """pack the response into bytes"""
-        return struct.pack("<BHI", self.version, self.code.value, self.payload_size)
+        return RESPONSE_HEADER.pack(self.version, self.code.value, self.payload_size)
 
 
 class ResponseSignUpSuccess(Response):
     """Response of ResponseCode.SIGN_UP_SUCCEEDED"""
 
+    HEADER = pack_response_header(ResponseCode.SIGN_UP_SUCCEEDED, CLIENT_ID_LEN)
+
     def __init__(self, client_id: bytes):
         super().__init__(ResponseCode.SIGN_UP_SUCCEEDED, CLIENT_ID_LEN)
         if len(client_id) != CLIENT_ID_LEN:
@@ -473,19 +259,28 @@ class ResponseSignUpSuccess(Response):
         self.client_id = client_id
 
     def pack(self) -> bytes:
-        return super().pack() + self.client_id
+        return self.HEADER + self.client_id
 
 
 class ResponseSignUpFailed(Response):
     """Response of ResponseCode.SIGN_UP_FAILED"""
 
+    HEADER = pack_response_header(ResponseCode.SIGN_UP_FAILED, 0)
+
     def __init__(self):
         super().__init__(ResponseCode.SIGN_UP_FAILED, 0)
 
+    def pack(self) -> bytes:
+        return self.HEADER
+
 
 class ResponsePublicKeyReceived(Response):
     """Response of ResponseCode.PUBLIC_KEY_RECEIVED"""
 
+    HEADER = pack_response_header(
+        ResponseCode.PUBLIC_KEY_RECEIVED, CLIENT_ID_LEN + ENCRYPTED_AES_KEY_SIZE
+    )
+
     def __init__(self, client_id: bytes, encrypted_aes_key: bytes):
         super().__init__(
             ResponseCode.PUBLIC_KEY_RECEIVED, CLIENT_ID_LEN + ENCRYPTED_AES_KEY_SIZE
@@ -502,12 +297,15 @@ class ResponsePublicKeyReceived(Response):
         self.key = encrypted_aes_key
 
     def pack(self) -> bytes:
-        return super().pack() + self.client_id + self.key
+        return self.HEADER + self.client_id + self.key
 
 
 class ResponseCRCValid(Response):
     """Response of ResponseCode.CRC_VALID"""
 
+    # the whole frame, the "s" format zero pads the filename to its full length
+    FRAME = struct.Struct(f"<BHI{CLIENT_ID_LEN}sI{MAX_FILE_NAME_LEN}sI")
+
     def __init__(self, client_id: bytes, content_size: int, filename: str, crc: int):
         super().__init__(
             ResponseCode.CRC_VALID, CLIENT_ID_LEN + 4 + MAX_FILE_NAME_LEN + 4
@@ -522,19 +320,22 @@ class ResponseCRCValid(Response):
         self.crc = crc
 
     def pack(self) -> bytes:
-        return (
-            super().pack()
-            + self.client_id
-            + struct.pack("<I", self.content_size)
-            + self.filename
-            + b"\0" * (MAX_FILE_NAME_LEN - len(self.filename))
-            + struct.pack("<I", self.crc)
+        return self.FRAME.pack(
+            self.version,
+            self.code.value,
+            self.payload_size,
+            self.client_id,
+            self.content_size,
+            self.filename,
+            self.crc,
         )
 
 
 class ResponseMessageReceived(Response):
     """Response of ResponseCode.MESSAGE_RECEIVED"""
 
+    HEADER = pack_response_header(ResponseCode.MESSAGE_RECEIVED, CLIENT_ID_LEN)
+
     def __init__(self, client_id: bytes):
         super().__init__(ResponseCode.MESSAGE_RECEIVED, CLIENT_ID_LEN)
         if len(client_id) != CLIENT_ID_LEN:
@@ -542,12 +343,16 @@ class ResponseMessageReceived(Response):
         self.client_id = client_id
 
     def pack(self) -> bytes:
-        return super().pack() + self.client_id
+        return self.HEADER + self.client_id
 
 
 class ResponseSignInAllowed(Response):
     """Response of ResponseCode.SIGN_IN_ALLOWED"""
 
+    HEADER = pack_response_header(
+        ResponseCode.SIGN_IN_ALLOWED, CLIENT_ID_LEN + ENCRYPTED_AES_KEY_SIZE
+    )
+
     def __init__(self, client_id: bytes, encrypted_aes_key: bytes):
         super().__init__(
             ResponseCode.SIGN_IN_ALLOWED, CLIENT_ID_LEN + ENCRYPTED_AES_KEY_SIZE
@@ -560,12 +365,14 @@ class ResponseSignInAllowed(Response):
         self.key = encrypted_aes_key
 
     def pack(self) -> bytes:
-        return super().pack() + self.client_id + self.key
+        return self.HEADER + self.client_id + self.key
 
 
 class ResponseSignInRejected(Response):
     """Response of ResponseCode.SIGN_IN_REJECTED"""
 
+    HEADER = pack_response_header(ResponseCode.SIGN_IN_REJECTED, CLIENT_ID_LEN)
+
     def __init__(self, client_id: bytes):
         super().__init__(ResponseCode.SIGN_IN_REJECTED, CLIENT_ID_LEN)
         if len(client_id) != CLIENT_ID_LEN:
@@ -573,15 +380,20 @@ class ResponseSignInRejected(Response):
         self.client_id = client_id
 
     def pack(self) -> bytes:
-        return super().pack() + self.client_id
+        return self.HEADER + self.client_id
 
 
 class ResponseGeneralError(Response):
     """Response of ResponseCode.GENERAL_ERROR"""
 
+    HEADER = pack_response_header(ResponseCode.GENERAL_ERROR, 0)
+
     def __init__(self):
         super().__init__(ResponseCode.GENERAL_ERROR, 0)
 
+    def pack(self) -> bytes:
+        return self.HEADER
+
 
 # Database Management
 
@@ -594,95 +406,131 @@ class DatabaseManager:
     TEMP_FILE_PATH = "saved"
     FILES_TABLE = "files"
 
+    # statements are built once, so sqlite3's per-connection statement cache
+    # (keyed by the SQL text) keeps reusing the same prepared statements
+    _INSERT_CLIENT = f"INSERT INTO {CLIENTS_TABLE} (id, name, public_key, last_seen, aes_key) VALUES (?, ?, ?, ?, ?);"
+    _SELECT_CLIENT_BY_NAME = f"SELECT id FROM {CLIENTS_TABLE} WHERE name = ?;"
+    _SELECT_CLIENT_BY_ID = (
+        f"SELECT id, name, public_key FROM {CLIENTS_TABLE} WHERE id = ?;"
+    )
+    _UPDATE_PUBLIC_KEY = f"UPDATE {CLIENTS_TABLE} SET public_key = ? WHERE id = ?;"
+    _UPDATE_AES_KEY = f"UPDATE {CLIENTS_TABLE} SET aes_key = ? WHERE id = ?;"
+    _INSERT_FILE = f"INSERT INTO {FILES_TABLE} (id, filename, saved_path, verified) VALUES (?, ?, ?, ?);"
+    _SET_FILE_VERIFIED = (
+        f"UPDATE {FILES_TABLE} SET verified = ? WHERE id = ? AND filename = ?;"
+    )
+
     def __init__(self):
         self.conn = sqlite3.connect(self.DB_FILE_NAME)
+        # WAL with synchronous=NORMAL only syncs on checkpoints, not on every commit
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self._transaction_depth = 0
         self._create_tables()
 
-    def create_new_client(self, username: str) -> None:
-        """Create a new client in the database."""
+    @contextlib.contextmanager
+    def transaction(self):
+        """Commit all the writes made inside the block at once, or none of them."""
+        self._transaction_depth += 1
+        try:
+            yield
+        except BaseException:
+            if self._transaction_depth == 1:
+                self.conn.rollback()
+            raise
+        else:
+            if self._transaction_depth == 1:
+                self.conn.commit()
+        finally:
+            self._transaction_depth -= 1
+
+    def create_new_client(self, username: str) -> bytes:
+        """Create a new client in the database and return its generated id."""
         self._validate_username(username)
         client_id = os.urandom(CLIENT_ID_LEN)
-        cursor = self.conn.cursor()
-        cursor.execute(
-            f"INSERT INTO {self.CLIENTS_TABLE} (id, name, public_key, last_seen, aes_key) VALUES (?, ?, ?, ?, ?);",
-            (client_id, username, bytes(0), time.asctime(), bytes(0)),
+        self.conn.execute(
+            self._INSERT_CLIENT,
+            (client_id, username, bytes(0), int(time.time()), bytes(0)),
         )
-        self.conn.commit()
-        cursor.close()
+        self._commit()
+        return client_id
 
     def get_client_by_name(self, username: str):
-        """Get a client by their username."""
+        """Get a client by their username, as an (id,) row."""
         self._validate_username(username)
-
-        cursor = self.conn.cursor()
-        cursor.execute(
-            f"SELECT * FROM {self.CLIENTS_TABLE} WHERE name = ?;", (username,)
-        )
-        rows = cursor.fetchall()
-        cursor.close()
-        if not rows:
+        row = self.conn.execute(self._SELECT_CLIENT_BY_NAME, (username,)).fetchone()
+        if row is None:
             return []
-        return rows[0]
+        return row
 
     def get_client_by_id(self, client_id):
-        """Get a client by their ID."""
-        cursor = self.conn.cursor()
-        cursor.execute(
-            f"SELECT * FROM {self.CLIENTS_TABLE} WHERE id = ?;", (client_id,)
-        )
-        rows = cursor.fetchall()
-        cursor.close()
-        if not rows:
+        """Get a client by their ID, as an (id, name, public_key) row."""
+        row = self.conn.execute(self._SELECT_CLIENT_BY_ID, (client_id,)).fetchone()
+        if row is None:
             return []
-        return rows[0]
+        return row
 
     def update_public_key(self, client_id, public_key):
         """Update a client's public key."""
-        cursor = self.conn.cursor()
-        cursor.execute(
-            f"UPDATE {self.CLIENTS_TABLE} SET public_key = ? WHERE id = ?;",
-            (public_key, client_id),
-        )
-        self.conn.commit()
-        cursor.close()
+        self.conn.execute(self._UPDATE_PUBLIC_KEY, (public_key, client_id))
+        self._commit()
 
     def update_aes_key(self, client_id, aes_key):
         """Update a client's AES key."""
-        cursor = self.conn.cursor()
-        cursor.execute(
-            f"UPDATE {self.CLIENTS_TABLE} SET aes_key = ? WHERE id = ?;",
-            (aes_key, client_id),
-        )
-        self.conn.commit()
-        cursor.close()
+        self.conn.execute(self._UPDATE_AES_KEY, (aes_key, client_id))
+        self._commit()
 
-    def insert_unvalidated_file(self, filename: str, file_content, file_id):
+    def insert_unvalidated_file(self, filename: str, file_chunks, file_id):
         """Insert a file into the database."""
         self._validate_filename(filename)
 
         if not os.path.exists(self.TEMP_FILE_PATH):
             os.mkdir(self.TEMP_FILE_PATH)
         file_path = self._id_to_path(file_id, filename)
-        with open(file_path, "wb") as f:
-            f.write(file_content)
+        self._write_file(file_path, file_chunks)
 
-        cursor = self.conn.cursor()
-        cursor.execute(
-            f"INSERT INTO {self.FILES_TABLE} (id, filename, saved_path, verified) VALUES (?, ?, ?, ?);",
-            (file_id, filename, file_path, 0),
-        )
-        self.conn.commit()
-        cursor.close()
+        self.conn.execute(self._INSERT_FILE, (file_id, filename, file_path, 0))
+        self._commit()
 
-    def set_file_to_valid(self, file_id):
+    # the most buffers a single writev accepts, 1024 where the platform can't tell
+    try:
+        _IOV_MAX = os.sysconf("SC_IOV_MAX")
+    except (AttributeError, ValueError, OSError):
+        _IOV_MAX = -1
+    if _IOV_MAX <= 0:
+        _IOV_MAX = 1024
+
+    @staticmethod
+    def _write_file(file_path: str, file_chunks) -> None:
+        """Write the chunks to a file with vectored writes, bypassing stdio buffering."""
+        if not hasattr(os, "writev"):
+            with open(file_path, "wb") as f:
+                f.writelines(file_chunks)
+            return
+
+        chunks = list(file_chunks)
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            i = 0
+            while i < len(chunks):
+                written = os.writev(fd, chunks[i : i + DatabaseManager._IOV_MAX])
+                # skip the chunks written in full and trim a partially written one
+                while i < len(chunks) and written >= len(chunks[i]):
+                    written -= len(chunks[i])
+                    i += 1
+                if written:
+                    chunks[i] = memoryview(chunks[i])[written:]
+        finally:
+            os.close(fd)
+
+    def set_file_to_valid(self, file_id, filename: str):
         """Set a file to be valid."""
-        cursor = self.conn.cursor()
-        cursor.execute(
-            f"UPDATE {self.FILES_TABLE} SET verified = ? WHERE filename = ?;",
-            (1, file_id),
-        )
-        self.conn.commit()
-        cursor.close()
+        self.conn.execute(self._SET_FILE_VERIFIED, (1, file_id, filename))
+        self._commit()
+
+    def _commit(self):
+        if not self._transaction_depth:
+            self.conn.commit()
 
     def _create_tables(self):
         cursor = self.conn.cursor()
@@ -691,7 +539,7 @@ class DatabaseManager:
                     id BLOB PRIMARY KEY,
                     name TEXT,
                     public_key BLOB,
-                    last_seen TEXT,
+                    last_seen INTEGER,
                     aes_key BLOB
                 )"""
         )
@@ -703,24 +551,37 @@ class DatabaseManager:
                     verified INTEGER
                 )"""
         )
+        cursor.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {self.CLIENTS_TABLE}_name ON {self.CLIENTS_TABLE} (name)"
+        )
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.FILES_TABLE}_id_filename ON {self.FILES_TABLE} (id, filename)"
+        )
         cursor.close()
 
+    # besides letters (and digits, for filenames), these characters are allowed
+    _USERNAME_EXTRA_CHARS = str.maketrans("", "", " ")
+    _FILENAME_EXTRA_CHARS = str.maketrans("", "", " ./")
+
     def _validate_username(self, username: str) -> None:
-        for ch in username:
-            if not ch.isalpha() and ch != " ":
-                raise ValueError("Invalid username.")
+        username = username.translate(self._USERNAME_EXTRA_CHARS)
+        if username and not username.isalpha():
+            raise ValueError("Invalid username.")
 
     def _validate_filename(self, username: str) -> None:
-        for ch in username:
-            if not ch.isalnum() and ch != " " and ch != "." and ch != "/":
-                raise ValueError("Invalid filename.")
+        username = username.translate(self._FILENAME_EXTRA_CHARS)
+        if username and not username.isalnum():
+            raise ValueError("Invalid filename.")
 
-    def _id_to_path(self, file_id, filename):
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _id_to_path(file_id, filename):
+        # memoized, a client usually resends the same file after a bad CRC
         return (
-            self.TEMP_FILE_PATH
+            DatabaseManager.TEMP_FILE_PATH
             + "/"
             + str(base64.b32encode(file_id), "utf-8")
-            + SHA256.new(bytes(filename, "utf-8")).hexdigest()
+            + hashlib.sha256(bytes(filename, "utf-8")).hexdigest()
             + ".tmp"
         )
 
@@ -729,16 +590,46 @@ class DatabaseManager:
 class ClientHandler:
     """A class to handle a client."""
 
+    RECEIVE_CHUNK_SIZE = 1 << 20
+    # zeros to extend receive buffers from, a view so no temporary bytes are made
+    _ZEROS = memoryview(bytes(RECEIVE_CHUNK_SIZE))
+
+    __slots__ = (
+        "sock",
+        "db",
+        "last_active_time",
+        "client_id",
+        "aes_key",
+        "username",
+        "filename",
+        "awaiting_file",
+        "active",
+        "_buffer",
+        "_received",
+        "_expected",
+        "_header",
+        "_outgoing",
+        "_public_key",
+        "_rsa",
+    )
+
     def __init__(self, client_sock: socket.socket, user_db: DatabaseManager):
         self.sock = client_sock
         self.db = user_db
         self.last_active_time = time.time()
-        self.client_id = bytes(CLIENT_ID_LEN)
+        self.client_id = EMPTY_CLIENT_ID
         self.aes_key = bytes(AES_KEY_SIZE)
         self.username = ""
         self.filename = ""
         self.awaiting_file = False
         self.active = True
+        self._buffer = bytearray(REQUEST_MIN_LEN)
+        self._received = 0
+        self._expected = REQUEST_MIN_LEN
+        self._outgoing = bytearray()
+        self._header = None
+        self._public_key = None
+        self._rsa = None
 
     def handle_message(self):
         """Handle a message from the client."""
@@ -746,74 +637,157 @@ class ClientHandler:
             raise RuntimeError(f"got message on inactive client {self.client_id}")
 
         self.last_active_time = time.time()
+        # drain the socket, it may already hold more than a single request, but stop
+        # reading once a response is stuck until the client reads its responses
+        while (
+            self.active
+            and not self._outgoing
+            and (received := self._receive()) is not None
+        ):
+            self._handle_request(*received)
+
+    def _handle_request(self, header: tuple, buffer: bytearray):
         try:
-            buffer = self.sock.recv(MAX_REQUEST_LENGTH)
-            request = Request(buffer)
-            match request.code:
-                case RequestCode.SIGN_UP:
-                    self._sign_up(request)
-                case RequestCode.SEND_PUBLIC_KEY:
-                    self._send_public_key(request)
-                case RequestCode.SIGN_IN:
-                    self._sign_in(request)
-                case RequestCode.SEND_FILE:
-                    self._send_file(request)
-                case RequestCode.CRC_VALID:
-                    self._handle_valid_crc(request)
-                case RequestCode.CRC_INVALID:
-                    self._handle_invalid_crc(request)
-                case RequestCode.CRC_INVALID_4TH_TIME:
-                    self._handle_invalid_crc_4th_time(request)
-                case _:
-                    raise ValueError(f"Invalid request code {request.code}")
+            # the header was unpacked while receiving, and the buffer sized by it
+            request = Request.from_parts(
+                *header, memoryview(buffer)[REQUEST_HEADER.size :]
+            )
+            # the code was checked against the known ones with the header
+            self._HANDLERS[request.code](self, request)
         except RuntimeError as e:
             print(
                 f"failed to handle request with error: {str(e)}\nfrom client: {self.client_id}"
             )
-            self.sock.send(ResponseGeneralError().pack())
+            self._send(ResponseGeneralError())
+
+    def _check_header(self, client_id: bytes, code: int, payload_size: int) -> None:
+        """Reject a request header before any of its payload is buffered."""
+        # the only place payload sizes are checked, the handlers rely on it
+        try:
+            code = RequestCode(code)
+        except ValueError:
+            raise RuntimeError(f"Invalid request code {code}") from None
+        if code is RequestCode.SEND_FILE:
+            # the only request with a large payload, and only when one is expected
+            if not self.awaiting_file:
+                raise RuntimeError("Received file request in login phase")
+            if client_id != self.client_id:
+                raise RuntimeError("Invalid client_id")
+            if payload_size <= 4 + MAX_FILE_NAME_LEN:
+                raise RuntimeError("Invalid (empty) file content")
+        elif payload_size != self._PAYLOAD_SIZES[code]:
+            raise RuntimeError(f"wrong payload size {payload_size} for {code.name}")
+
+    def _receive(self):
+        """Receive the current request until it is complete or the socket runs dry."""
+        while True:
+            if self._received == len(self._buffer):
+                # grow at most a chunk ahead of what actually arrived, the small
+                # fixed-size requests get their exact size in one step
+                grow = min(self._expected - self._received, self.RECEIVE_CHUNK_SIZE)
+                self._buffer += self._ZEROS[:grow]
+            try:
+                received = self.sock.recv_into(
+                    memoryview(self._buffer)[self._received :]
+                )
+            except BlockingIOError:
+                return None
+            except ConnectionError:
+                received = 0
+            if not received:
+                self.active = False
+                return None
+            self._received += received
+            if self._received < self._expected:
+                continue
+
+            if self._header is None:
+                self._header = REQUEST_HEADER.unpack_from(self._buffer)
+                client_id, _, code, payload_size = self._header
+                try:
+                    self._check_header(client_id, code, payload_size)
+                except RuntimeError as e:
+                    # the payload is never read, reply and close once the reply is out
+                    print(
+                        f"rejected request header with error: {str(e)}\nfrom client: {self.client_id}"
+                    )
+                    self._send(ResponseGeneralError())
+                    self.active = False
+                    return None
+                self._expected += payload_size
+                if self._received < self._expected:
+                    continue
+
+            header, buffer = self._header, self._buffer
+            self._header = None
+            self._buffer = bytearray(REQUEST_MIN_LEN)
+            self._received = 0
+            self._expected = REQUEST_MIN_LEN
+            return header, buffer
+
+    def handle_writable(self):
+        """Send what is left of the queued responses."""
+        self._flush()
+
+    @property
+    def wants_write(self) -> bool:
+        """Whether responses are still waiting for the socket to take them."""
+        return bool(self._outgoing)
+
+    def _send(self, response: Response):
+        # queued, the non-blocking socket may take only part of the frame right now
+        self._outgoing += response.pack()
+        self._flush()
+
+    def _flush(self):
+        while self._outgoing:
+            try:
+                sent = self.sock.send(self._outgoing)
+            except BlockingIOError:
+                return
+            except OSError:
+                # the peer is gone, what is queued can't be delivered anymore
+                self._outgoing.clear()
+                self.active = False
+                return
+            del self._outgoing[:sent]
 
     @staticmethod
     def _bytes_to_string(b: bytes) -> str:
-        return str(b.split(bytes([ord("\0")]))[0], "utf-8")
+        return str(bytes(b).split(bytes([ord("\0")]))[0], "utf-8")
 
     def _sign_up(self, request: Request):
         if self.awaiting_file:
             raise RuntimeError("got registration message in file phase")
-        if request.payload_size != MAX_USER_NAME_LEN:
-            raise RuntimeError("wrong payload size in registration")
 
         username = ClientHandler._bytes_to_string(request.payload)
         if self.db.get_client_by_name(username):
-            self.sock.send(ResponseSignUpFailed().pack())
+            self._send(ResponseSignUpFailed())
             return
-        self.db.create_new_client(username)
-        self.client_id = self.db.get_client_by_name(username)[0]
-        self.sock.send(ResponseSignUpSuccess(self.client_id).pack())
+        self.client_id = self.db.create_new_client(username)
+        self._send(ResponseSignUpSuccess(self.client_id))
 
     def _send_public_key(self, request: Request):
         if self.awaiting_file:
             raise RuntimeError("got public key message in file phase")
-        if request.payload_size != MAX_USER_NAME_LEN + PUBLIC_KEY_SIZE:
-            raise RuntimeError("wrong payload size in public key")
 
         username = ClientHandler._bytes_to_string(request.payload[:MAX_USER_NAME_LEN])
-        public_key = request.payload[MAX_USER_NAME_LEN:]
+        public_key = bytes(request.payload[MAX_USER_NAME_LEN:])
         if self.client_id != request.client_id or self.username != username:
             raise RuntimeError("client_id or username not matching")
 
-        self.db.update_public_key(self.client_id, public_key)
-        enc_aes_key = self._get_encrypted_aes_key(public_key)
-        self.sock.send(ResponsePublicKeyReceived(self.client_id, enc_aes_key).pack())
+        with self.db.transaction():
+            self.db.update_public_key(self.client_id, public_key)
+            enc_aes_key = self._get_encrypted_aes_key(public_key)
+        self._send(ResponsePublicKeyReceived(self.client_id, enc_aes_key))
         self.awaiting_file = True
 
     def _sign_in(self, request: Request):
         if self.awaiting_file:
             raise RuntimeError("got login message in file phase")
-        if request.payload_size != MAX_USER_NAME_LEN:
-            raise RuntimeError("wrong payload size in login")
         client_row = self.db.get_client_by_id(request.client_id)
         if not client_row or not client_row[2]:
-            self.sock.send(ResponseSignInRejected(request.client_id).pack())
+            self._send(ResponseSignInRejected(request.client_id))
             return
         username = ClientHandler._bytes_to_string(request.payload[:MAX_USER_NAME_LEN])
         if username != client_row[1]:
@@ -822,16 +796,10 @@ class ClientHandler:
         self.client_id = request.client_id
         self.username = username
         enc_aes_key = self._get_encrypted_aes_key(client_row[2])
-        self.sock.send(ResponseSignInAllowed(self.client_id, enc_aes_key).pack())
+        self._send(ResponseSignInAllowed(self.client_id, enc_aes_key))
         self.awaiting_file = True
 
     def _send_file(self, request: Request):
-        if not self.awaiting_file:
-            raise RuntimeError("Received file request in login phase")
-        if self.client_id != request.client_id:
-            raise RuntimeError("Invalid client_id")
-        if request.payload_size <= 4 + MAX_FILE_NAME_LEN:
-            raise RuntimeError("Invalid (empty) file content")
         (content_size,) = struct.unpack("<I", request.payload[:4])
         padded_content_size = (content_size // AES_KEY_SIZE) * AES_KEY_SIZE
         if content_size % AES_KEY_SIZE != 0:
@@ -842,10 +810,10 @@ class ClientHandler:
         encrypted_file = request.payload[
             MAX_FILE_NAME_LEN + 4 : MAX_FILE_NAME_LEN + 4 + padded_content_size
         ]
+        # saved under this name, and the CRC replies must refer to the same one
+        self.filename = filename
         file_crc = self._decrypt_and_save_file(encrypted_file, content_size)
-        self.sock.send(
-            ResponseCRCValid(self.client_id, content_size, filename, file_crc).pack()
-        )
+        self._send(ResponseCRCValid(self.client_id, content_size, filename, file_crc))
         self.awaiting_file = False
 
     def _handle_valid_crc(self, request: Request):
@@ -853,19 +821,15 @@ class ClientHandler:
             raise RuntimeError("Received valid crc request while waiting for file")
         if self.client_id != request.client_id:
             raise RuntimeError("Invalid client_id")
-        if request.payload_size != MAX_FILE_NAME_LEN:
-            raise RuntimeError("Invalid payload size")
         filename = ClientHandler._bytes_to_string(request.payload)
         if filename != self.filename:
             raise RuntimeError("Invalid filename")
-        self.db.set_file_to_valid(self.client_id)
-        self.sock.send(ResponseMessageReceived(self.client_id).pack())
+        self.db.set_file_to_valid(self.client_id, filename)
+        self._send(ResponseMessageReceived(self.client_id))
 
     def _handle_invalid_crc(self, request: Request):
         if self.client_id != request.client_id:
             raise RuntimeError("Invalid client_id")
-        if request.payload_size != MAX_FILE_NAME_LEN:
-            raise RuntimeError("Invalid payload size")
         filename = ClientHandler._bytes_to_string(request.payload)
         if filename != self.filename:
             raise RuntimeError("Invalid filename")
@@ -876,40 +840,65 @@ class ClientHandler:
             raise RuntimeError("Received terminate request in login phase")
         if self.client_id != request.client_id:
             raise RuntimeError("Invalid client_id")
-        if request.payload_size != MAX_FILE_NAME_LEN:
-            raise RuntimeError("Invalid payload size")
         filename = ClientHandler._bytes_to_string(request.payload)
         if filename != self.filename:
             raise RuntimeError("Invalid filename")
-        self.sock.send(ResponseMessageReceived(self.client_id).pack())
+        self._send(ResponseMessageReceived(self.client_id))
         self.active = False
 
     def _get_encrypted_aes_key(self, public_key):
         self.aes_key = os.urandom(AES_KEY_SIZE)
         self.db.update_aes_key(self.client_id, self.aes_key)
 
-        rsa_key = RSA.import_key(public_key)
-        rsa = PKCS1_OAEP.new(rsa_key)
-        return rsa.encrypt(self.aes_key)
+        # importing the key is far costlier than encrypting, do it once per key
+        if public_key != self._public_key:
+            self._rsa = PKCS1_OAEP.new(RSA.import_key(public_key))
+            self._public_key = bytes(public_key)
+        return self._rsa.encrypt(self.aes_key)
 
     def _decrypt_and_save_file(self, encrypted_file, content_size):
-        file_content = bytes()
-        for i in range(len(encrypted_file) // AES_KEY_SIZE):
-            aes = AES.new(self.aes_key, mode=AES.MODE_CBC, IV=bytes(AES_KEY_SIZE))
-            file_content += aes.decrypt(
-                encrypted_file[i * AES_KEY_SIZE : (i + 1) * AES_KEY_SIZE]
-            )
-        if len(file_content) < content_size:
+        padded_content_size = -(-content_size // AES_KEY_SIZE) * AES_KEY_SIZE
+        if len(encrypted_file) < padded_content_size:
             raise RuntimeError("File decryption failed")
-        file_content = file_content[:content_size]
-        self.db.insert_unvalidated_file(self.filename, file_content, self.client_id)
-        return memcrc(file_content)
+
+        # decrypt and checksum chunk by chunk, while each chunk is still in cache
+        aes = AES.new(self.aes_key, mode=AES.MODE_CBC, IV=ZERO_IV)
+        checksum = Checksum()
+        file_chunks = []
+        for offset in range(0, padded_content_size, FILE_CHUNK_SIZE):
+            end = min(offset + FILE_CHUNK_SIZE, padded_content_size)
+            chunk = aes.decrypt(encrypted_file[offset:end])[: content_size - offset]
+            checksum.update(chunk)
+            file_chunks.append(chunk)
+        self.db.insert_unvalidated_file(self.filename, file_chunks, self.client_id)
+        return checksum.digest()
+
+    # payload sizes of every request but SEND_FILE, checked as soon as the header is in
+    _PAYLOAD_SIZES = {
+        RequestCode.SIGN_UP: MAX_USER_NAME_LEN,
+        RequestCode.SEND_PUBLIC_KEY: MAX_USER_NAME_LEN + PUBLIC_KEY_SIZE,
+        RequestCode.SIGN_IN: MAX_USER_NAME_LEN,
+        RequestCode.CRC_VALID: MAX_FILE_NAME_LEN,
+        RequestCode.CRC_INVALID: MAX_FILE_NAME_LEN,
+        RequestCode.CRC_INVALID_4TH_TIME: MAX_FILE_NAME_LEN,
+    }
+    # a single dict lookup per request instead of walking a chain of cases
+    _HANDLERS = {
+        RequestCode.SIGN_UP: _sign_up,
+        RequestCode.SEND_PUBLIC_KEY: _send_public_key,
+        RequestCode.SIGN_IN: _sign_in,
+        RequestCode.SEND_FILE: _send_file,
+        RequestCode.CRC_VALID: _handle_valid_crc,
+        RequestCode.CRC_INVALID: _handle_invalid_crc,
+        RequestCode.CRC_INVALID_4TH_TIME: _handle_invalid_crc_4th_time,
+    }
 
 
 class Server:
     """A server class with two public functions: run and stop."""
 
     MAX_CONNECTIONS = 100
+    SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
 
     def __init__(self, host: str) -> None:
         self.port = Server._read_port()
@@ -929,16 +918,40 @@ class Server:
         except (FileNotFoundError, ValueError):
             return DEFAULT_PORT
 
-    def _start(self, sock: socket.socket) -> None:
+    def _start(self, sock: socket.socket, mask: int) -> None:
         """Start the server."""
         conn, _ = sock.accept()
         conn.setblocking(False)
         client = ClientHandler(conn, self.db)
-        self.sel.register(conn, selectors.EVENT_READ, client.handle_message)
+        self.sel.register(
+            conn, selectors.EVENT_READ, functools.partial(self._serve, client)
+        )
+
+    def _serve(self, client: ClientHandler, conn: socket.socket, mask: int) -> None:
+        """Serve a client whose socket is readable or writable."""
+        if mask & selectors.EVENT_WRITE:
+            client.handle_writable()
+        elif client.active:
+            client.handle_message()
+        if not client.active and not client.wants_write:
+            self.sel.unregister(conn)
+            conn.close()
+            return
+
+        # while a response is queued wait for the client to take it, and read nothing
+        events = selectors.EVENT_WRITE if client.wants_write else selectors.EVENT_READ
+        key = self.sel.get_key(conn)
+        if key.events != events:
+            self.sel.modify(conn, events, key.data)
 
     def _create_socket(self) -> None:
         """Create the server socket."""
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # accepted sockets inherit this, set before listening so the window
+        # scale offered in the handshake can cover it
+        self.sock.setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, Server.SOCKET_BUFFER_SIZE
+        )
         self.sock.bind((self.host, self.port))
         self.sock.listen(Server.MAX_CONNECTIONS)
         self.sock.setblocking(False)
@@ -949,8 +962,8 @@ class Server:
         self._create_socket()
         while self.not_stopped:
             events = self.sel.select()
-            for key, _ in events:
-                key.data(key.fileobj)
+            for key, mask in events:
+                key.data(key.fileobj, mask)
 
     def stop(self) -> None:
         """Stop the server."""